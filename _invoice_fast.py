@@ -0,0 +1,212 @@
+# Чистые функции сборки накладной без Flask/WeasyPrint.
+# Модуль целиком аннотирован, чтобы его можно было собрать mypyc:
+#   mypyc _invoice_fast.py
+# собранный .so лежит рядом и импортируется вместо .py без изменений в app.py.
+import os
+import string
+import time
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from markupsafe import Markup
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# путь к логотипу задаётся только здесь: app.py берёт LOGO_FILE для ReportLab и url_fetcher,
+# шаблон получает относительное имя, которое WeasyPrint резолвит от BASE_DIR
+LOGO_NAME = "blossom_logo.png"
+LOGO_FILE = os.path.join(BASE_DIR, LOGO_NAME)
+# логотип проверяется один раз при импорте, а не stat() на каждую накладную
+_LOGO_PATH = LOGO_NAME if os.path.exists(LOGO_FILE) else ""
+
+_MSK = ZoneInfo("Europe/Moscow")
+_GENERATION_DT_FMT = "%d.%m.%Y %H:%M"
+_HEADER_DATE_FMT = "%d.%m.%Y"
+
+
+# A-Z -> a-z и удаление всего, кроме [a-z0-9_-], за один проход bytes.translate
+_FILENAME_TABLE = bytes.maketrans(string.ascii_uppercase.encode(), string.ascii_lowercase.encode())
+_FILENAME_DELETE = bytes(c for c in range(128) if not (chr(c).isalnum() or chr(c) in "_-"))
+
+
+def safe_filename(s: Optional[str]) -> str:
+    # split() без аргументов = strip + схлопывание пробельных серий
+    s = "_".join((s or "").split())
+    s = s.encode("ascii", "ignore").translate(_FILENAME_TABLE, _FILENAME_DELETE).decode("ascii")
+    return (s[:60] or "file")
+
+
+_ESC_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+
+def esc(v: Any) -> str:
+    return ("" if v is None else str(v)).translate(_ESC_TABLE)
+
+
+def to_float(v: Any, default: float = 0.0) -> float:
+    try:
+        return float(v)
+    except Exception:
+        return default
+
+
+_RU_MONTHS = {
+    1: "января",
+    2: "февраля",
+    3: "марта",
+    4: "апреля",
+    5: "мая",
+    6: "июня",
+    7: "июля",
+    8: "августа",
+    9: "сентября",
+    10: "октября",
+    11: "ноября",
+    12: "декабря",
+}
+
+
+def format_ru_date(s: str) -> str:
+    s = (s or "").strip()
+    if not s:
+        return "—"
+
+    dt: Optional[date] = None
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d", "%d.%m.%y"):
+        try:
+            dt = datetime.strptime(s, fmt).date()
+            break
+        except Exception:
+            pass
+
+    if dt is None:
+        return s
+
+    return f"{dt.day} {_RU_MONTHS.get(dt.month, '')} {dt.year} г."
+
+
+@lru_cache(maxsize=1)
+def msk_now_strings(minute: int) -> Tuple[str, str]:
+    # смещение МСК кратно часу, поэтому минутная корзина по UTC совпадает с минутой по МСК
+    now_dt = datetime.fromtimestamp(minute * 60, _MSK)
+    return now_dt.strftime(_GENERATION_DT_FMT), now_dt.strftime(_HEADER_DATE_FMT)
+
+
+def extract_invoice_fields(payload: Dict[str, Any]) -> Dict[str, Any]:
+    get = payload.get
+
+    salon_name = str(get("salon_name") or "Салон")
+
+    generation_dt_str, today_str = msk_now_strings(int(time.time() // 60))
+
+    header_date_str = str(get("invoice_date") or get("date") or today_str)
+
+    order_id = str(get("order_id") or "UNKNOWN")
+
+    customer_name = str(get("customer_name") or "Не указано")
+    customer_email = str(get("customer_email") or "—")
+    customer_phone = str(get("customer_phone") or "—")
+
+    items = get("items")
+    if not isinstance(items, list):
+        items = []
+    # позиции разбираются один раз в параллельные списки (SoA): HTML, ReportLab,
+    # текстовое сообщение и итог дальше только итерируют zip без .get()/float()
+    names = [item.get("name", "") for item in items]
+    quantities = [to_float(item.get("quantity", 0)) for item in items]
+    prices = [to_float(item.get("price", 0)) for item in items]
+
+    delivery_address = str(get("delivery_address") or "Не указано")
+
+    raw_total = get("total_sum")
+    if raw_total is None:
+        # сумма не пришла — считаем по позициям так же, как колонка «Сумма»
+        total_sum = sum([qty * price for qty, price in zip(quantities, prices)])
+    else:
+        total_sum = to_float(raw_total)
+
+    return {
+        "salon_name": salon_name,
+        "generation_dt_str": generation_dt_str,
+        "header_date_str": header_date_str,
+        "order_id": order_id,
+        "customer_name": customer_name,
+        "customer_email": customer_email,
+        "customer_phone": customer_phone,
+        "names": names,
+        "quantities": quantities,
+        "prices": prices,
+        "delivery_address": delivery_address,
+        "total_sum": total_sum,
+        "logo_path": _LOGO_PATH,
+    }
+
+
+# шаблон компилируется один раз, байткод кешируется на диске между рестартами воркеров
+_JINJA_ENV = Environment(
+    loader=FileSystemLoader(os.path.join(BASE_DIR, "templates")),
+    autoescape=True,
+    bytecode_cache=FileSystemBytecodeCache(),
+    trim_blocks=True,
+    lstrip_blocks=True,
+    finalize=lambda v: "" if v is None else v,
+)
+_INVOICE_TEMPLATE = _JINJA_ENV.get_template("invoice.html.j2")
+
+# строка товара собирается %-форматированием, а не макросом Jinja:
+# на длинных накладных вызовы макроса на каждую ячейку заметно дороже.
+# чётные строки получают класс alt здесь, чтобы WeasyPrint не матчил :nth-child на каждой
+_ROW_TEMPLATE = (
+    '<div class="row%s">'
+    '<div class="cell-idx"><span class="numbox" style="width:2ch">%d</span></div>'
+    '<div class="cell-name">%s</div>'
+    '<div class="cell-qty"><span class="numbox" style="width:5ch">%g</span></div>'
+    '<div class="cell-price"><span class="numbox" style="width:8ch">%.2f</span></div>'
+    '<div class="cell-sum"><span class="numbox" style="width:8ch">%.2f</span></div>'
+    "</div>\n"
+)
+
+
+def build_invoice_html(
+    salon_name: str,
+    sender_name: str,
+    sender_phone: str,
+    logo_path: str,
+    order_id: str,
+    customer_name: str,
+    customer_email: str,
+    customer_phone: str,
+    names: List[Any],
+    quantities: List[float],
+    prices: List[float],
+    delivery_address: str,
+    total_sum: float,
+    generation_dt_str: str,
+    header_date_str: str,
+) -> str:
+    header_date_ru = format_ru_date(header_date_str)
+
+    rows_html = "".join([
+        _ROW_TEMPLATE % ("" if idx % 2 else " alt", idx, esc(name), qty, price, price * qty)
+        for idx, (name, qty, price) in enumerate(zip(names, quantities, prices), start=1)
+    ])
+
+    return _INVOICE_TEMPLATE.render(
+        salon_name=salon_name,
+        sender_name=sender_name,
+        sender_phone=sender_phone,
+        logo_path=logo_path,
+        order_id=order_id,
+        customer_name=customer_name,
+        customer_email=customer_email,
+        customer_phone=customer_phone,
+        rows_html=Markup(rows_html),
+        delivery_address=delivery_address,
+        total_sum=total_sum,
+        generation_dt_str=generation_dt_str,
+        header_date_ru=header_date_ru,
+    )
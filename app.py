@@ -1,45 +1,178 @@
 import os
-import re
 import io
-import html
+import base64
+import uuid
+import hashlib
+import hmac
+import importlib.util
+import multiprocessing
+import sys
+import threading
+import time
+import zipfile
+import orjson
 import requests
-from datetime import datetime
-from zoneinfo import ZoneInfo
-from functools import wraps
-
-from flask import Flask, request, jsonify, make_response
-from weasyprint import HTML
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, wraps
+
+from flask import Flask, request, make_response, send_file
+from markupsafe import Markup
+
+from _invoice_fast import (
+    BASE_DIR,
+    LOGO_FILE,
+    build_invoice_html,
+    esc,
+    extract_invoice_fields,
+    format_ru_date,
+    msk_now_strings,
+    safe_filename,
+)
 
 
 app = Flask(__name__)
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 BOT_TOKEN = os.environ.get("BLOSSOM_BOT_TOKEN")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")
 INTERNAL_API_TOKEN = os.environ.get("INTERNAL_API_TOKEN")
+# токен не меняется за жизнь процесса: кодируется один раз, а не на каждый запрос
+_INTERNAL_TOKEN_BYTES = (INTERNAL_API_TOKEN or "").encode()
 
 SENDER_NAME = os.environ.get("SENDER_NAME", "—")
 SENDER_PHONE = os.environ.get("SENDER_PHONE", "—")
+# отправитель не меняется за жизнь процесса: экранируется один раз, шаблон получает готовую разметку
+_SENDER_NAME_HTML = Markup(esc(SENDER_NAME))
+_SENDER_PHONE_HTML = Markup(esc(SENDER_PHONE))
+
+INVOICE_WORKERS = int(os.environ.get("INVOICE_WORKERS", "4"))
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES") or os.cpu_count() or 2)
+RENDER_TIMEOUT = int(os.environ.get("RENDER_TIMEOUT", "120"))
+# после стольких рендеров процесс пула пересоздаётся (Python 3.11+): память Pango/Cairo не копится; 0 — без перезапуска
+RENDER_MAX_TASKS = int(os.environ.get("RENDER_MAX_TASKS", "200"))
+# накладные с числом позиций не больше этого уходят текстом через sendMessage, без PDF; 0 — всегда PDF
+INVOICE_TEXT_MAX_ITEMS = int(os.environ.get("INVOICE_TEXT_MAX_ITEMS", "0"))
+INVOICE_BATCH_MAX = int(os.environ.get("INVOICE_BATCH_MAX", "50"))
+PDF_CACHE_SIZE = int(os.environ.get("PDF_CACHE_SIZE", "256"))
+SENT_CACHE_TTL = int(os.environ.get("SENT_CACHE_TTL", str(24 * 3600)))
+SENT_CACHE_SIZE = 1024
+TASKS_SIZE = 1024
+
+# "weasyprint" (по умолчанию), "reportlab" — PDF собирается напрямую, без HTML/CSS (reportlab есть в requirements.txt),
+# или "chromium" — тёплый headless Chromium через Playwright
+# (нужны `pip install playwright` и `playwright install chromium`), WeasyPrint остаётся запасным
+PDF_ENGINE = os.environ.get("PDF_ENGINE", "weasyprint").strip().lower()
+# движок -> пакет, без которого он не работает; проверяется один раз при импорте, а не падением на каждой накладной
+_PDF_ENGINE_PACKAGES = {"weasyprint": "weasyprint", "reportlab": "reportlab", "chromium": "playwright"}
+if PDF_ENGINE not in _PDF_ENGINE_PACKAGES:
+    raise ValueError(f"PDF_ENGINE must be one of {', '.join(_PDF_ENGINE_PACKAGES)}, got {PDF_ENGINE!r}")
+if PDF_ENGINE != "weasyprint" and importlib.util.find_spec(_PDF_ENGINE_PACKAGES[PDF_ENGINE]) is None:
+    app.logger.warning("PDF_ENGINE=%s, but %s is not installed; using WeasyPrint", PDF_ENGINE, _PDF_ENGINE_PACKAGES[PDF_ENGINE])
+    PDF_ENGINE = "weasyprint"
+REPORTLAB_FONT_DIR = os.environ.get("REPORTLAB_FONT_DIR", "/usr/share/fonts/truetype/dejavu")
 
 TG_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
-
-def _cors(resp):
-    resp.headers["Access-Control-Allow-Origin"] = "*"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, X-Internal-Token"
-    resp.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS, GET"
+# рендер + отправка в Telegram идут в фоне, HTTP-запрос не ждёт WeasyPrint
+_SEND_POOL = ThreadPoolExecutor(max_workers=INVOICE_WORKERS, thread_name_prefix="invoice-send")
+# накладные из /admin/invoice/batch собираются в своих потоках: пачка на 50 штук не встаёт
+# в очередь перед фоновыми отправками, а рендеров идёт столько же, сколько процессов в пуле
+_BATCH_POOL = ThreadPoolExecutor(max_workers=RENDER_PROCESSES, thread_name_prefix="invoice-batch")
+
+# sync API Playwright привязан к потоку, в котором запущен браузер,
+# поэтому все обращения к Chromium идут через один выделенный поток
+_CHROMIUM_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chromium")
+_playwright = None
+_chromium_browser = None
+_chromium_page = None
+
+# WeasyPrint рендерит в отдельных процессах: CPU-работа не держит GIL воркера,
+# пока потоки _SEND_POOL выгружают в Telegram уже готовые накладные.
+# Пул создаётся лениво, уже в воркере gunicorn, а не в мастере при --preload.
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+# готовые (pdf, filename, caption, order_id) по хешу payload:
+# повторы (ретраи, реплеи вебхуков) не гоняют WeasyPrint заново
+_PDF_CACHE: "OrderedDict[bytes, tuple]" = OrderedDict()
+_PDF_CACHE_LOCK = threading.Lock()
+
+# ответы Telegram на уже отправленные заказы: повторная отправка того же заказа
+# (ретраи, реплеи вебхуков) не рендерит и не выгружает PDF ещё раз
+_SENT_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+_SENT_CACHE_LOCK = threading.Lock()
+
+# фьючерсы фоновых отправок по task_id для /admin/invoice/status; хранятся последние TASKS_SIZE
+_TASKS: "OrderedDict[str, object]" = OrderedDict()
+_TASKS_LOCK = threading.Lock()
+
+# одна keep-alive сессия на процесс: TLS-рукопожатие с api.telegram.org не повторяется на каждую накладную
+_TG_SESSION = requests.Session()
+_TG_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+    ),
+)
+
+
+_CORS_HEADERS = [
+    ("Access-Control-Allow-Origin", "*"),
+    ("Access-Control-Allow-Headers", "Content-Type, X-Internal-Token"),
+    ("Access-Control-Allow-Methods", "POST, OPTIONS, GET"),
     # полезно, если фронт/веб захочет прочитать имя файла
-    resp.headers["Access-Control-Expose-Headers"] = "Content-Disposition"
-    return resp
+    ("Access-Control-Expose-Headers", "Content-Disposition"),
+]
+
+
+class CORSMiddleware:
+    # CORS-заголовки дописываются одним списком в start_response для любого ответа,
+    # включая 401/404/500 от самого Flask, вместо правки Headers в каждом view
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        def cors_start_response(status, headers, exc_info=None):
+            return start_response(status, headers + _CORS_HEADERS, exc_info)
+
+        return self.wsgi_app(environ, cors_start_response)
+
+
+app.wsgi_app = CORSMiddleware(app.wsgi_app)
+
+
+def _json(obj):
+    # orjson (Rust) вместо stdlib json у jsonify
+    return app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+
+def _get_payload():
+    # тело нужно один раз: cache=False не оставляет копию в request
+    data = request.get_data(cache=False)
+    if not data:
+        return {}
+    try:
+        return orjson.loads(data) or {}
+    except orjson.JSONDecodeError:
+        return {}
+
+
+# готовый 401: запросы без токена и сканеры не тратят CPU на сериализацию и сборку ответа
+_UNAUTHORIZED = app.response_class('{"error":"Unauthorized"}\n', status=401, mimetype="application/json")
 
 
 def require_internal_token(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = request.headers.get("X-Internal-Token")
-        if not token or token != INTERNAL_API_TOKEN:
-            return _cors(jsonify({"error": "Unauthorized"})), 401
+        token = request.headers.get("X-Internal-Token", "").encode()
+        if not token or not _INTERNAL_TOKEN_BYTES or not hmac.compare_digest(token, _INTERNAL_TOKEN_BYTES):
+            return _UNAUTHORIZED
         return f(*args, **kwargs)
 
     return decorated
@@ -47,503 +180,773 @@ def require_internal_token(f):
 
 @app.get("/")
 def health():
-    return _cors(jsonify({"ok": True}))
+    return _json({"ok": True})
 
 
-def _safe_filename(s: str) -> str:
-    s = (s or "").strip().lower()
-    s = re.sub(r"\s+", "_", s)
-    s = re.sub(r"[^a-z0-9_\-]+", "", s)
-    return (s[:60] or "file")
+def send_pdf(chat_id: str, pdf_bytes: bytes, filename: str, caption: str):
+    if not BOT_TOKEN:
+        raise RuntimeError("BLOSSOM_BOT_TOKEN is not set")
+    for attempt in range(3):
+        # multipart-тело отдаётся в сокет кусками, без второй полной копии PDF в памяти;
+        # поток одноразовый, поэтому на повтор собирается заново
+        body = MultipartEncoder(fields={
+            "chat_id": str(chat_id),
+            "caption": caption,
+            "parse_mode": "HTML",
+            "document": (filename, io.BytesIO(pdf_bytes), "application/pdf"),
+        })
+        r = _TG_SESSION.post(
+            f"{TG_API}/sendDocument",
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=60,
+        )
+        if r.status_code != 429 or attempt == 2:
+            break
+        # flood control: 429 значит, что запрос не принят, Telegram сам говорит, сколько ждать
+        try:
+            retry_after = int(r.json()["parameters"]["retry_after"])
+        except Exception:
+            retry_after = 1
+        time.sleep(min(retry_after, 30))
+    if not r.ok:
+        raise RuntimeError(f"Telegram error {r.status_code}: {r.text}")
+    return r.json()
 
 
-def send_pdf(chat_id: str, pdf_bytes: bytes, filename: str, caption: str):
+def send_message(chat_id: str, text: str):
     if not BOT_TOKEN:
         raise RuntimeError("BLOSSOM_BOT_TOKEN is not set")
-    files = {"document": (filename, pdf_bytes, "application/pdf")}
-    data = {"chat_id": chat_id, "caption": caption, "parse_mode": "HTML"}
-    r = requests.post(f"{TG_API}/sendDocument", data=data, files=files, timeout=60)
+    r = _TG_SESSION.post(
+        f"{TG_API}/sendMessage",
+        data={"chat_id": str(chat_id), "text": text, "parse_mode": "HTML"},
+        timeout=30,
+    )
     if not r.ok:
         raise RuntimeError(f"Telegram error {r.status_code}: {r.text}")
     return r.json()
 
 
-def build_invoice_html(
-    salon_name: str,
-    sender_name: str,
-    sender_phone: str,
-    logo_path: str,
-    order_id: str,
-    customer_name: str,
-    customer_email: str,
-    customer_phone: str,
-    items: list,
-    delivery_address: str,
-    total_sum: float,
-    generation_dt_str: str,
-    header_date_str: str,
-) -> str:
-    def esc(v):
-        return html.escape("" if v is None else str(v))
-
-    def num_cell(value: str, width_ch: int) -> str:
-        v = esc(value)
-        return f'<span class="numbox" style="width:{width_ch}ch">{v}</span>'
-
-    def format_ru_date(s: str) -> str:
-        s = (s or "").strip()
-        if not s:
-            return "—"
-
-        dt = None
-        for fmt in ("%d.%m.%Y", "%Y-%m-%d", "%d.%m.%y"):
-            try:
-                dt = datetime.strptime(s, fmt).date()
-                break
-            except Exception:
-                pass
-
-        if dt is None:
-            return s
-
-        months = {
-            1: "января",
-            2: "февраля",
-            3: "марта",
-            4: "апреля",
-            5: "мая",
-            6: "июня",
-            7: "июля",
-            8: "августа",
-            9: "сентября",
-            10: "октября",
-            11: "ноября",
-            12: "декабря",
-        }
-        return f"{dt.day} {months.get(dt.month, '')} {dt.year} г."
-
-    header_date_ru = format_ru_date(header_date_str)
-
-    rows = []
-    for idx, item in enumerate(items or [], start=1):
-        name = esc(item.get("name", ""))
+def _tg_getme():
+    try:
+        _TG_SESSION.get(f"{TG_API}/getMe", timeout=10)
+    except Exception:
+        app.logger.warning("Telegram prewarm failed", exc_info=True)
+
 
+def _tg_prewarm():
+    # вызывается из gunicorn post_worker_init: соединение открывается уже в воркере,
+    # так что первая накладная не платит за DNS и TLS-рукопожатие.
+    # getMe идёт в фоновом потоке: post_worker_init выполняется до heartbeat воркера,
+    # и зависший Telegram с ретраями _TG_SESSION держал бы его дольше gunicorn timeout
+    if not BOT_TOKEN:
+        return
+    threading.Thread(target=_tg_getme, name="tg-prewarm", daemon=True).start()
+
+
+# CSS накладной парсится один раз на процесс и передаётся в WeasyPrint готовым объектом
+_INVOICE_CSS_TEXT = """
+@page { size: 148mm 210mm; margin: 10mm 10mm 12mm 10mm; }
+
+body {
+  font-family: "DejaVu Sans", sans-serif;
+  color: #1a1a1a;
+}
+
+/* --- HEADER --- */
+.header {
+  border-bottom: 2px solid #2c3e50;
+  padding: 0 0 2mm 0;
+  margin: 0 0 6px 0;
+}
+
+/* flex вместо grid: раскладка WeasyPrint для него дешевле */
+.header-grid {
+  display: flex;
+  align-items: flex-start;
+}
+
+.h-left, .h-right {
+  flex: 1 1 0;  /* равные боковые колонки — центр всегда по центру страницы */
+}
+
+.h-center {
+  flex: 0 0 auto;
+  margin: 0 6mm;
+  text-align: center;
+}
+
+.h-right {
+  text-align: right;
+}
+
+.logo {
+  width: 18mm;          /* логотип больше */
+  height: auto;
+  display: block;
+  margin-top: -2.5mm;   /* логотип выше */
+}
+
+.header-date {
+  font-size: 10px;
+  color: #666;
+  white-space: nowrap;
+  margin-top: -1.5mm;   /* дата выше */
+}
+
+.title {
+  margin: 0;
+  font-size: 19px;      /* заголовок больше */
+  font-weight: 900;
+  letter-spacing: -0.2px;
+  color: #2c3e50;
+  line-height: 1.1;
+}
+
+.subtitle {
+  margin-top: 2px;
+  font-size: 13px;      /* салон больше */
+  color: #666;
+  line-height: 1.15;
+  font-weight: 600;
+}
+
+/* --- SENDER --- */
+.sender {
+  margin: 8px 0 10px 0;
+  border: 1px solid #d8e6f2;
+  background: #eef6ff;
+  border-radius: 10px;
+  padding: 8px 10px;
+}
+.sender .label {
+  font-size: 9px;
+  font-weight: 800;
+  text-transform: uppercase;
+  letter-spacing: 0.6px;
+  color: #2c3e50;
+  margin-bottom: 4px;
+}
+.sender .value {
+  font-size: 12px;
+  font-weight: 900;
+  color: #1a1a1a;
+}
+.sender .phone {
+  font-weight: 800;
+  color: #2c3e50;
+}
+
+/* --- META --- */
+.meta-info {
+  display: flex;
+  margin-bottom: 10px;
+  font-size: 10.5px;
+}
+.meta-section {
+  flex: 1 1 0;
+  border: 1px solid #e0e0e0;
+  border-radius: 10px;
+  padding: 8px 10px;
+  background: #f9f9f9;
+}
+.meta-section + .meta-section {
+  margin-left: 10px;  /* gap во flex WeasyPrint не поддерживает */
+}
+.meta-section .label {
+  font-weight: 800;
+  color: #555;
+  font-size: 9px;
+  text-transform: uppercase;
+  letter-spacing: 0.5px;
+  margin-bottom: 4px;
+}
+.meta-section .value {
+  color: #1a1a1a;
+  line-height: 1.35;
+  word-break: break-word;
+}
+
+.section-title {
+  font-weight: 900;
+  font-size: 11px;
+  color: #2c3e50;
+  margin: 10px 0 6px 0;
+  text-transform: uppercase;
+  letter-spacing: 0.5px;
+}
+
+/* --- ITEMS --- */
+/* flex-строки вместо <table>: ширины колонок и так фиксированы,
+   а табличная раскладка WeasyPrint пересчитывает их по всем ячейкам */
+.items {
+  width: 100%;
+}
+.items .row {
+  display: flex;
+  align-items: center;
+  border-bottom: 1px solid #e8e8e8;
+  font-size: 10px;
+  break-inside: avoid;
+}
+.items .row > div {
+  box-sizing: border-box;
+  padding: 7px 8px;
+}
+.items .row.head {
+  align-items: stretch;
+  background: #f0f0f0;
+  font-weight: 800;
+  color: #333;
+  border-bottom: 2px solid #d0d0d0;
+}
+.items .row.alt {
+  background: #fafafa;
+}
+
+.cell-idx { flex: 0 0 9mm; }
+.cell-name { flex: 1 1 0; min-width: 0; }
+.cell-qty { flex: 0 0 18mm; }
+.cell-price { flex: 0 0 24mm; }
+.cell-sum { flex: 0 0 25mm; }
+.cell-idx, .cell-qty, .cell-price, .cell-sum { text-align: right; }
+.items .row.head .cell-idx { text-align: left; }
+
+.numbox {
+  display: inline-block;
+  text-align: right;
+  white-space: nowrap;
+  font-family: "DejaVu Sans Mono", monospace;
+}
+
+.muted {
+  flex: 1 1 auto;
+  color: #888;
+  font-style: italic;
+  text-align: center;
+}
+
+.totals {
+  margin-top: 8px;
+  padding-top: 8px;
+  border-top: 2px solid #d0d0d0;
+}
+.total-row {
+  display: flex;
+  align-items: baseline;
+}
+.total-label {
+  flex: 1 1 auto;
+  text-align: right;
+  font-weight: 700;
+  font-size: 11px;
+  color: #333;
+  padding-right: 10px;
+}
+.total-amount {
+  flex: 0 0 42mm;
+  text-align: right;
+  font-weight: 900;
+  font-size: 14px;
+  color: #2c3e50;
+  white-space: nowrap;
+  font-family: "DejaVu Sans Mono", monospace;
+}
+
+.footer {
+  margin-top: 12px;
+  padding-top: 8px;
+  border-top: 1px solid #ddd;
+  font-size: 9px;
+  color: #666;
+  line-height: 1.35;
+}
+"""
+# картинки между рендерами (логотип разбирается раз на процесс); пока кеш общий, optimize_images и dpi не включать
+_IMAGE_CACHE: dict = {}
+
+
+@lru_cache(maxsize=1)
+def _weasyprint():
+    # WeasyPrint (Pango, Cairo, cffi, Pillow) импортируется только там, где рендерит, — в процессах пула;
+    # веб-процессу он не нужен, и старт воркера с /health не платят за этот импорт
+    from weasyprint import HTML, CSS
+    from weasyprint.text.fonts import FontConfiguration
+
+    # одна FontConfiguration на процесс: шрифты не ищутся в fontconfig заново на каждый рендер
+    font_config = FontConfiguration()
+    return HTML, CSS(string=_INVOICE_CSS_TEXT, font_config=font_config), font_config
+
+
+@lru_cache(maxsize=1)
+def _logo_bytes() -> bytes:
+    with open(LOGO_FILE, "rb") as fp:
+        return fp.read()
+
+
+@lru_cache(maxsize=1)
+def _logo_data_uri() -> str:
+    return "data:image/png;base64," + base64.b64encode(_logo_bytes()).decode("ascii")
+
+
+def _chromium_close():
+    # после падения браузера или закрытой страницы хэндлы мертвы: закрываем что осталось,
+    # останавливаем драйвер Playwright и обнуляем, чтобы следующий рендер запустил Chromium заново
+    global _playwright, _chromium_browser, _chromium_page
+    if _chromium_browser is not None:
         try:
-            qty = float(item.get("quantity", 0))
+            _chromium_browser.close()
         except Exception:
-            qty = 0.0
-
+            pass
+    if _playwright is not None:
         try:
-            price = float(item.get("price", 0))
+            _playwright.stop()
         except Exception:
-            price = 0.0
-
-        amount = price * qty
-
-        rows.append(
-            f"""
-          <tr>
-            <td class="td-idx">{num_cell(str(idx), 2)}</td>
-            <td class="td-name">{name}</td>
-            <td class="td-qty">{num_cell(f"{qty:g}", 5)}</td>
-            <td class="td-price">{num_cell(f"{price:.2f}", 8)}</td>
-            <td class="td-sum">{num_cell(f"{amount:.2f}", 8)}</td>
-          </tr>
-        """
-        )
+            pass
+    _playwright = _chromium_browser = _chromium_page = None
 
-    tbody = "\n".join(rows) if rows else """
-      <tr><td colspan="5" class="muted">Товары не указаны</td></tr>
-    """
-
-    logo_html = ""
-    if logo_path:
-        logo_html = f'<img class="logo" src="{esc(logo_path)}" alt="logo">'
-
-    return f"""
-    <html>
-      <head>
-        <meta charset="utf-8">
-        <style>
-          @page {{ size: 148mm 210mm; margin: 10mm 10mm 12mm 10mm; }}
-
-          body {{
-            font-family: DejaVu Sans, Arial, sans-serif;
-            color: #1a1a1a;
-          }}
-
-          /* --- HEADER --- */
-          .header {{
-            border-bottom: 2px solid #2c3e50;
-            padding: 0 0 2mm 0;
-            margin: 0 0 6px 0;
-          }}
-
-          .header-grid {{
-            display: grid;
-            grid-template-columns: 1fr auto 1fr; /* центр всегда по центру страницы */
-            align-items: start;
-            column-gap: 6mm;
-          }}
-
-          .h-left {{
-            justify-self: start;
-          }}
-
-          .h-center {{
-            justify-self: center;
-            text-align: center;
-          }}
-
-          .h-right {{
-            justify-self: end;
-            text-align: right;
-          }}
-
-          .logo {{
-            width: 18mm;          /* логотип больше */
-            height: auto;
-            display: block;
-            margin-top: -2.5mm;   /* логотип выше */
-          }}
-
-          .header-date {{
-            font-size: 10px;
-            color: #666;
-            white-space: nowrap;
-            margin-top: -1.5mm;   /* дата выше */
-          }}
-
-          .title {{
-            margin: 0;
-            font-size: 19px;      /* заголовок больше */
-            font-weight: 900;
-            letter-spacing: -0.2px;
-            color: #2c3e50;
-            line-height: 1.1;
-          }}
-
-          .subtitle {{
-            margin-top: 2px;
-            font-size: 13px;      /* салон больше */
-            color: #666;
-            line-height: 1.15;
-            font-weight: 600;
-          }}
-
-          /* --- SENDER --- */
-          .sender {{
-            margin: 8px 0 10px 0;
-            border: 1px solid #d8e6f2;
-            background: #eef6ff;
-            border-radius: 10px;
-            padding: 8px 10px;
-          }}
-          .sender .label {{
-            font-size: 9px;
-            font-weight: 800;
-            text-transform: uppercase;
-            letter-spacing: 0.6px;
-            color: #2c3e50;
-            margin-bottom: 4px;
-          }}
-          .sender .value {{
-            font-size: 12px;
-            font-weight: 900;
-            color: #1a1a1a;
-          }}
-          .sender .phone {{
-            font-weight: 800;
-            color: #2c3e50;
-          }}
-
-          /* --- META --- */
-          .meta-info {{
-            display: grid;
-            grid-template-columns: 1fr 1fr;
-            gap: 10px;
-            margin-bottom: 10px;
-            font-size: 10.5px;
-          }}
-          .meta-section {{
-            border: 1px solid #e0e0e0;
-            border-radius: 10px;
-            padding: 8px 10px;
-            background: #f9f9f9;
-          }}
-          .meta-section .label {{
-            font-weight: 800;
-            color: #555;
-            font-size: 9px;
-            text-transform: uppercase;
-            letter-spacing: 0.5px;
-            margin-bottom: 4px;
-          }}
-          .meta-section .value {{
-            color: #1a1a1a;
-            line-height: 1.35;
-            word-break: break-word;
-          }}
-
-          .section-title {{
-            font-weight: 900;
-            font-size: 11px;
-            color: #2c3e50;
-            margin: 10px 0 6px 0;
-            text-transform: uppercase;
-            letter-spacing: 0.5px;
-          }}
-
-          /* --- ITEMS TABLE --- */
-          table.items {{
-            width: 100%;
-            border-collapse: collapse;
-            table-layout: fixed;
-          }}
-          col.cw-idx {{ width: 9mm; }}
-          col.cw-qty {{ width: 18mm; }}
-          col.cw-price {{ width: 24mm; }}
-          col.cw-sum {{ width: 25mm; }}
-
-          table.items thead th {{
-            background: #f0f0f0;
-            font-size: 10px;
-            font-weight: 800;
-            color: #333;
-            border-bottom: 2px solid #d0d0d0;
-            padding: 7px 8px;
-          }}
-          table.items tbody td {{
-            border-bottom: 1px solid #e8e8e8;
-            padding: 7px 8px;
-            font-size: 10px;
-            vertical-align: middle;
-          }}
-          table.items tbody tr:nth-child(2n) td {{
-            background: #fafafa;
-          }}
-
-          th.th-num {{ text-align: right; }}
-          td.td-idx, td.td-qty, td.td-price, td.td-sum {{ text-align: right; }}
-
-          .numbox {{
-            display: inline-block;
-            text-align: right;
-            white-space: nowrap;
-            font-family: ui-monospace, SFMono-Regular, Menlo, Consolas, "Liberation Mono", monospace;
-          }}
-
-          .muted {{
-            color: #888;
-            font-style: italic;
-            text-align: center;
-          }}
-
-          .totals {{
-            margin-top: 8px;
-            padding-top: 8px;
-            border-top: 2px solid #d0d0d0;
-          }}
-          .total-row {{
-            display: table;
-            width: 100%;
-          }}
-          .total-label {{
-            display: table-cell;
-            text-align: right;
-            font-weight: 700;
-            font-size: 11px;
-            color: #333;
-            padding-right: 10px;
-          }}
-          .total-amount {{
-            display: table-cell;
-            width: 42mm;
-            text-align: right;
-            font-weight: 900;
-            font-size: 14px;
-            color: #2c3e50;
-            white-space: nowrap;
-            font-family: ui-monospace, SFMono-Regular, Menlo, Consolas, "Liberation Mono", monospace;
-          }}
-
-          .footer {{
-            margin-top: 12px;
-            padding-top: 8px;
-            border-top: 1px solid #ddd;
-            font-size: 9px;
-            color: #666;
-            line-height: 1.35;
-          }}
-        </style>
-      </head>
-      <body>
-
-        <div class="header">
-          <div class="header-grid">
-            <div class="h-left">{logo_html}</div>
-
-            <div class="h-center">
-              <div class="title">Накладная заказа №{esc(order_id)}</div>
-              <div class="subtitle">{esc(salon_name)}</div>
-            </div>
-
-            <div class="h-right">
-              <div class="header-date">{esc(header_date_ru)}</div>
-            </div>
-          </div>
-        </div>
-
-        <div class="sender">
-          <div class="label">От кого</div>
-          <div class="value">{esc(sender_name)} <span class="phone">({esc(sender_phone)})</span></div>
-        </div>
-
-        <div class="meta-info">
-          <div class="meta-section">
-            <div class="label">Клиент</div>
-            <div class="value">
-              <strong>{esc(customer_name)}</strong><br>
-              {esc(customer_email)}<br>
-              {esc(customer_phone)}
-            </div>
-          </div>
-
-          <div class="meta-section">
-            <div class="label">Адрес доставки</div>
-            <div class="value">{esc(delivery_address)}</div>
-          </div>
-        </div>
-
-        <div class="section-title">Товары</div>
-        <table class="items">
-          <colgroup>
-            <col class="cw-idx">
-            <col>
-            <col class="cw-qty">
-            <col class="cw-price">
-            <col class="cw-sum">
-          </colgroup>
-          <thead>
-            <tr>
-              <th>№</th>
-              <th>Наименование</th>
-              <th class="th-num">Кол-во</th>
-              <th class="th-num">Цена</th>
-              <th class="th-num">Сумма</th>
-            </tr>
-          </thead>
-          <tbody>
-            {tbody}
-          </tbody>
-        </table>
-
-        <div class="totals">
-          <div class="total-row">
-            <div class="total-label">Итого к оплате:</div>
-            <div class="total-amount">{total_sum:.2f} ₽</div>
-          </div>
-        </div>
-
-        <div class="footer">
-          <div>Дата генерации (МСК): {esc(generation_dt_str)}</div>
-          <div>@BlossomffBot • Автоматически сформировано системой</div>
-        </div>
-
-      </body>
-    </html>
-    """
-
-
-def _extract_invoice_fields(payload: dict):
-    salon_name = str(payload.get("salon_name") or "Салон")
-
-    now_dt = datetime.now(ZoneInfo("Europe/Moscow"))
-    generation_dt_str = now_dt.strftime("%d.%m.%Y %H:%M")
-
-    header_date_str = (
-        payload.get("invoice_date")
-        or payload.get("date")
-        or now_dt.strftime("%d.%m.%Y")
-    )
-    header_date_str = str(header_date_str)
 
-    order_id = str(payload.get("order_id") or "UNKNOWN")
+def _chromium_render(html_doc: str) -> bytes:
+    global _playwright, _chromium_browser, _chromium_page
+    try:
+        if _chromium_page is None:
+            from playwright.sync_api import sync_playwright
 
-    customer_name = str(payload.get("customer_name") or "Не указано")
-    customer_email = str(payload.get("customer_email") or "—")
-    customer_phone = str(payload.get("customer_phone") or "—")
+            _playwright = sync_playwright().start()
+            _chromium_browser = _playwright.chromium.launch(args=["--no-sandbox"])
+            _chromium_page = _chromium_browser.new_page()
+
+        _chromium_page.set_content(html_doc, wait_until="load")
+        _chromium_page.add_style_tag(content=_INVOICE_CSS_TEXT)
+        return _chromium_page.pdf(prefer_css_page_size=True, print_background=True)
+    except Exception:
+        _chromium_close()
+        raise
+
+
+def _weasyprint_render(html_doc: str) -> bytes:
+    # presentational hints шаблон не использует; потоки PDF сжимаются самим WeasyPrint,
+    # .pdf.gz поверх Telegram не откроет в превью. Шрифты встраиваются подмножеством (full_fonts=False).
+    HTML, stylesheet, font_config = _weasyprint()
+    return HTML(string=html_doc, base_url=BASE_DIR).write_pdf(
+        stylesheets=[stylesheet],
+        font_config=font_config,
+        presentational_hints=False,
+        optimize_images=False,
+        full_fonts=False,
+        hinting=False,
+        uncompressed_pdf=False,
+        cache=_IMAGE_CACHE,
+    )
 
-    items = payload.get("items") if isinstance(payload.get("items"), list) else []
-    delivery_address = str(payload.get("delivery_address") or "Не указано")
 
+def _warmup():
+    # initializer процессов пула: первый рендер грузит fontconfig, кеши Pango и Cairo
+    # до первой настоящей накладной
     try:
-        total_sum = float(payload.get("total_sum", 0))
+        HTML, stylesheet, font_config = _weasyprint()
+        HTML(string='<p>0 <span class="numbox">0</span></p>').write_pdf(
+            stylesheets=[stylesheet], font_config=font_config
+        )
     except Exception:
-        total_sum = 0.0
+        app.logger.exception("WeasyPrint warmup failed")
+
+
+@lru_cache(maxsize=1)
+def _reportlab_fonts():
+    # TTF регистрируются один раз на процесс; кириллице нужны DejaVu, встроенная Helvetica её не знает
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.lib.fonts import addMapping
+
+    for family in ("DejaVuSans", "DejaVuSansMono"):
+        pdfmetrics.registerFont(TTFont(family, os.path.join(REPORTLAB_FONT_DIR, f"{family}.ttf")))
+        pdfmetrics.registerFont(TTFont(f"{family}-Bold", os.path.join(REPORTLAB_FONT_DIR, f"{family}-Bold.ttf")))
+        # <b> в Paragraph ищет жирное начертание через маппинг семейства
+        addMapping(family, 0, 0, family)
+        addMapping(family, 1, 0, f"{family}-Bold")
+        addMapping(family, 0, 1, family)
+        addMapping(family, 1, 1, f"{family}-Bold")
+    return True
+
+
+def _reportlab_render(f: dict) -> bytes:
+    # та же накладная, собранная platypus-флоублами без разбора HTML/CSS;
+    # размеры взяты из _INVOICE_CSS_TEXT (px) и переведены в pt
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.lib.units import mm
+    from reportlab.platypus import Image, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    _reportlab_fonts()
+    px = 0.75
+    color = colors.HexColor
+
+    base = ParagraphStyle("base", fontName="DejaVuSans", fontSize=10 * px, leading=13 * px, textColor=color("#1a1a1a"))
+    label = ParagraphStyle("label", base, fontName="DejaVuSans-Bold", fontSize=9 * px, textColor=color("#555555"))
+    num = ParagraphStyle("num", base, fontName="DejaVuSansMono", alignment=TA_RIGHT)
+    small = ParagraphStyle("small", base, fontSize=9 * px, leading=12 * px, textColor=color("#666666"))
+
+    width = 128 * mm
+    logo = Image(LOGO_FILE, width=18 * mm, height=18 * mm, kind="proportional") if f["logo_path"] else ""
+
+    header = Table(
+        [[
+            logo,
+            [
+                Paragraph(
+                    f"Накладная заказа №{esc(f['order_id'])}",
+                    ParagraphStyle("title", base, fontName="DejaVuSans-Bold", fontSize=19 * px, leading=23 * px,
+                                   alignment=TA_CENTER, textColor=color("#2c3e50")),
+                ),
+                Paragraph(
+                    esc(f["salon_name"]),
+                    ParagraphStyle("subtitle", base, fontSize=13 * px, leading=16 * px, alignment=TA_CENTER,
+                                   textColor=color("#666666")),
+                ),
+            ],
+            Paragraph(esc(format_ru_date(f["header_date_str"])), ParagraphStyle("date", small, fontSize=10 * px, alignment=TA_RIGHT)),
+        ]],
+        colWidths=[26 * mm, width - 62 * mm, 36 * mm],
+    )
+    header.setStyle(TableStyle([
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+        ("LINEBELOW", (0, 0), (-1, 0), 2 * px, color("#2c3e50")),
+        ("BOTTOMPADDING", (0, 0), (-1, 0), 8 * px),
+    ]))
+
+    sender = Table(
+        [[[
+            Paragraph("ОТ КОГО", ParagraphStyle("sender-label", label, textColor=color("#2c3e50"))),
+            Paragraph(
+                f"<b>{_SENDER_NAME_HTML}</b> <font color='#2c3e50'>({_SENDER_PHONE_HTML})</font>",
+                ParagraphStyle("sender-value", base, fontSize=12 * px, leading=15 * px),
+            ),
+        ]]],
+        colWidths=[width],
+    )
+    sender.setStyle(TableStyle([
+        ("BACKGROUND", (0, 0), (-1, -1), color("#eef6ff")),
+        ("BOX", (0, 0), (-1, -1), 1 * px, color("#d8e6f2")),
+        ("ROUNDEDCORNERS", [10 * px] * 4),
+    ]))
+
+    meta_value = ParagraphStyle("meta-value", base, fontSize=10.5 * px, leading=14 * px)
+    meta = Table(
+        [[
+            [
+                Paragraph("КЛИЕНТ", label),
+                Paragraph(
+                    f"<b>{esc(f['customer_name'])}</b><br/>{esc(f['customer_email'])}<br/>{esc(f['customer_phone'])}",
+                    meta_value,
+                ),
+            ],
+            "",
+            [Paragraph("АДРЕС ДОСТАВКИ", label), Paragraph(esc(f["delivery_address"]), meta_value)],
+        ]],
+        colWidths=[(width - 10 * px) / 2, 10 * px, (width - 10 * px) / 2],
+    )
+    meta.setStyle(TableStyle([
+        ("VALIGN", (0, 0), (-1, -1), "TOP"),
+        ("BACKGROUND", (0, 0), (0, 0), color("#f9f9f9")),
+        ("BACKGROUND", (2, 0), (2, 0), color("#f9f9f9")),
+        ("BOX", (0, 0), (0, 0), 1 * px, color("#e0e0e0")),
+        ("BOX", (2, 0), (2, 0), 1 * px, color("#e0e0e0")),
+    ]))
+
+    rows = [["№", "Наименование", "Кол-во", "Цена", "Сумма"]]
+    for idx, (name, qty, price) in enumerate(zip(f["names"], f["quantities"], f["prices"]), start=1):
+        rows.append([
+            Paragraph("%d" % idx, num),
+            Paragraph(esc(name), base),
+            Paragraph("%g" % qty, num),
+            Paragraph("%.2f" % price, num),
+            Paragraph("%.2f" % (price * qty), num),
+        ])
+    if not f["names"]:
+        muted = ParagraphStyle("muted", base, fontName="DejaVuSans", alignment=TA_CENTER, textColor=color("#888888"))
+        rows.append([Paragraph("Товары не указаны", muted)])
+
+    items = Table(rows, colWidths=[9 * mm, width - 76 * mm, 18 * mm, 24 * mm, 25 * mm], repeatRows=1)
+    items_style = [
+        ("FONT", (0, 0), (-1, 0), "DejaVuSans-Bold", 10 * px),
+        ("TEXTCOLOR", (0, 0), (-1, 0), color("#333333")),
+        ("BACKGROUND", (0, 0), (-1, 0), color("#f0f0f0")),
+        ("ALIGN", (2, 0), (-1, 0), "RIGHT"),
+        ("LINEBELOW", (0, 0), (-1, 0), 2 * px, color("#d0d0d0")),
+        ("LINEBELOW", (0, 1), (-1, -1), 1 * px, color("#e8e8e8")),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, color("#fafafa")]),
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+        ("LEFTPADDING", (0, 0), (-1, -1), 8 * px),
+        ("RIGHTPADDING", (0, 0), (-1, -1), 8 * px),
+        ("TOPPADDING", (0, 0), (-1, -1), 7 * px),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 7 * px),
+    ]
+    if not f["names"]:
+        items_style.append(("SPAN", (0, 1), (-1, 1)))
+    items.setStyle(TableStyle(items_style))
+
+    totals = Table(
+        [[
+            Paragraph(
+                "<b>Итого к оплате:</b>",
+                ParagraphStyle("total-label", base, fontSize=11 * px, alignment=TA_RIGHT, textColor=color("#333333")),
+            ),
+            Paragraph(
+                "%.2f ₽" % f["total_sum"],
+                ParagraphStyle("total-amount", num, fontName="DejaVuSansMono-Bold", fontSize=14 * px, leading=17 * px,
+                               textColor=color("#2c3e50")),
+            ),
+        ]],
+        colWidths=[width - 42 * mm, 42 * mm],
+    )
+    totals.setStyle(TableStyle([
+        ("VALIGN", (0, 0), (-1, -1), "BOTTOM"),
+        ("LINEABOVE", (0, 0), (-1, 0), 2 * px, color("#d0d0d0")),
+        ("TOPPADDING", (0, 0), (-1, -1), 8 * px),
+    ]))
+
+    footer = Table(
+        [
+            [Paragraph(f"Дата генерации (МСК): {esc(f['generation_dt_str'])}", small)],
+            [Paragraph("@BlossomffBot • Автоматически сформировано системой", small)],
+        ],
+        colWidths=[width],
+    )
+    footer.setStyle(TableStyle([("LINEABOVE", (0, 0), (-1, 0), 1 * px, color("#dddddd"))]))
+
+    section = ParagraphStyle("section", label, fontSize=11 * px, leading=14 * px, textColor=color("#2c3e50"))
+    story = [
+        header, Spacer(1, 8 * px),
+        sender, Spacer(1, 8 * px),
+        meta, Spacer(1, 10 * px),
+        Paragraph("ТОВАРЫ", section), Spacer(1, 6 * px),
+        items, Spacer(1, 8 * px),
+        totals, Spacer(1, 12 * px),
+        footer,
+    ]
+
+    buf = io.BytesIO()
+    SimpleDocTemplate(
+        buf,
+        pagesize=(148 * mm, 210 * mm),
+        leftMargin=10 * mm,
+        rightMargin=10 * mm,
+        topMargin=10 * mm,
+        bottomMargin=12 * mm,
+        title=f"Накладная {f['order_id']}",
+    ).build(story)
+    return buf.getvalue()
+
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn, а не fork: форк из многопоточного gthread-воркера небезопасен
+            kwargs = {}
+            if sys.version_info >= (3, 11):
+                # max_tasks_per_child появился в 3.11; на старых версиях процессы пула не пересоздаются
+                kwargs["max_tasks_per_child"] = RENDER_MAX_TASKS or None
+            _render_pool = ProcessPoolExecutor(
+                max_workers=RENDER_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warmup,
+                **kwargs,
+            )
+        return _render_pool
+
+
+def _render_pool_prewarm():
+    # вызывается из gunicorn post_worker_init: процессы пула поднимаются и прогреваются
+    # при старте воркера, а не на первой накладной; каждый submit без свободного процесса порождает новый
+    if PDF_ENGINE != "weasyprint":
+        return
+    pool = _get_render_pool()
+    for _ in range(RENDER_PROCESSES):
+        pool.submit(int)
+
+
+def _render_pdf(html_doc: str) -> bytes:
+    if PDF_ENGINE == "chromium":
+        try:
+            return _CHROMIUM_POOL.submit(_chromium_render, html_doc).result(timeout=60)
+        except Exception:
+            app.logger.exception("Chromium render failed, falling back to WeasyPrint")
+
+    # таймаут, чтобы зависший рендер не держал поток запроса бесконечно
+    return _get_render_pool().submit(_weasyprint_render, html_doc).result(timeout=RENDER_TIMEOUT)
 
-    logo_path = "blossom_logo.png" if os.path.exists(os.path.join(BASE_DIR, "blossom_logo.png")) else ""
 
-    return {
-        "salon_name": salon_name,
-        "generation_dt_str": generation_dt_str,
-        "header_date_str": header_date_str,
-        "order_id": order_id,
-        "customer_name": customer_name,
-        "customer_email": customer_email,
-        "customer_phone": customer_phone,
-        "items": items,
-        "delivery_address": delivery_address,
-        "total_sum": total_sum,
-        "logo_path": logo_path,
-    }
+def _pdf_cache_key(payload: dict) -> bytes:
+    # ключ по самому payload: повтор того же заказа не разбирает поля и не собирает HTML.
+    # дата шапки без явной даты в payload — «сегодня», поэтому она тоже входит в ключ
+    _generation_dt_str, today_str = msk_now_strings(int(time.time() // 60))
+    blob = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.blake2b(blob + today_str.encode("utf-8"), digest_size=16).digest()
+
+
+def _pdf_cache_get(key: bytes):
+    with _PDF_CACHE_LOCK:
+        result = _PDF_CACHE.get(key)
+        if result is not None:
+            _PDF_CACHE.move_to_end(key)
+        return result
+
+
+def _pdf_cache_put(key: bytes, result: tuple):
+    with _PDF_CACHE_LOCK:
+        _PDF_CACHE[key] = result
+        while len(_PDF_CACHE) > PDF_CACHE_SIZE:
+            _PDF_CACHE.popitem(last=False)
 
 
 def _build_invoice_pdf(payload: dict):
-    f = _extract_invoice_fields(payload)
-
-    html_doc = build_invoice_html(
-        salon_name=f["salon_name"],
-        sender_name=SENDER_NAME,
-        sender_phone=SENDER_PHONE,
-        logo_path=f["logo_path"],
-        order_id=f["order_id"],
-        customer_name=f["customer_name"],
-        customer_email=f["customer_email"],
-        customer_phone=f["customer_phone"],
-        items=f["items"],
-        delivery_address=f["delivery_address"],
-        total_sum=f["total_sum"],
-        generation_dt_str=f["generation_dt_str"],
-        header_date_str=f["header_date_str"],
-    )
+    key = _pdf_cache_key(payload)
+    cached = _pdf_cache_get(key)
+    if cached is not None:
+        return cached
 
-    pdf_bytes = HTML(string=html_doc, base_url=BASE_DIR).write_pdf()
+    f = extract_invoice_fields(payload)
 
-    safe_salon = _safe_filename(f["salon_name"])
-    safe_order = _safe_filename(f["order_id"])
+    pdf_bytes = None
+    if PDF_ENGINE == "reportlab":
+        try:
+            pdf_bytes = _reportlab_render(f)
+        except Exception:
+            app.logger.exception("ReportLab render failed, falling back to WeasyPrint")
+
+    if pdf_bytes is None:
+        logo_path = f["logo_path"]
+        if logo_path and PDF_ENGINE == "chromium":
+            # страница Chromium открыта на about:blank, относительный путь к логотипу там не резолвится
+            logo_path = _logo_data_uri()
+
+        html_doc = build_invoice_html(
+            salon_name=f["salon_name"],
+            sender_name=_SENDER_NAME_HTML,
+            sender_phone=_SENDER_PHONE_HTML,
+            logo_path=logo_path,
+            order_id=f["order_id"],
+            customer_name=f["customer_name"],
+            customer_email=f["customer_email"],
+            customer_phone=f["customer_phone"],
+            names=f["names"],
+            quantities=f["quantities"],
+            prices=f["prices"],
+            delivery_address=f["delivery_address"],
+            total_sum=f["total_sum"],
+            generation_dt_str=f["generation_dt_str"],
+            header_date_str=f["header_date_str"],
+        )
+
+        pdf_bytes = _render_pdf(html_doc)
+
+    safe_salon = safe_filename(f["salon_name"])
+    safe_order = safe_filename(f["order_id"])
     filename = f'{f["header_date_str"]}_{safe_salon}_{safe_order}.pdf'
 
-    caption = (
-        f"<b>🧾 Накладная заказа №</b><code>{html.escape(f['order_id'])}</code>\n"
-        f"<b>📅 Дата:</b> <code>{html.escape(f['header_date_str'])}</code>\n"
-        f"<b>👤 Клиент:</b> <code>{html.escape(f['salon_name'])}</code>\n"
+    result = (pdf_bytes, filename, _invoice_caption(f), f["order_id"])
+    _pdf_cache_put(key, result)
+    return result
+
+
+def _invoice_caption(f: dict) -> str:
+    return (
+        f"<b>🧾 Накладная заказа №</b><code>{esc(f['order_id'])}</code>\n"
+        f"<b>📅 Дата:</b> <code>{esc(f['header_date_str'])}</code>\n"
+        f"<b>👤 Клиент:</b> <code>{esc(f['salon_name'])}</code>\n"
         f"<b>💸 Общая сумма:</b> <code>{f['total_sum']:.2f} ₽</code>"
     )
 
-    return pdf_bytes, filename, caption, f["order_id"]
+
+def _build_invoice_text(payload: dict):
+    # None — накладная слишком большая для текста, нужен PDF
+    f = extract_invoice_fields(payload)
+    if len(f["names"]) > INVOICE_TEXT_MAX_ITEMS:
+        return None
+
+    lines = [_invoice_caption(f), ""]
+    for idx, (name, qty, price) in enumerate(zip(f["names"], f["quantities"], f["prices"]), start=1):
+        lines.append(f"{idx}. {esc(name)} — {qty:g} × {price:.2f} = <b>{price * qty:.2f} ₽</b>")
+    lines += ["", f"<b>📍 Адрес доставки:</b> {esc(f['delivery_address'])}"]
+
+    text = "\n".join(lines)
+    # лимит sendMessage — 4096 символов
+    return text if len(text) <= 4096 else None
+
+
+def _sent_key(payload: dict):
+    if not payload.get("order_id"):
+        return None
+
+    # ключ по всему payload, как у _pdf_cache_key: исправленные адрес, клиент или дата
+    # дают новый ключ, и накладная уходит заново, а не отвечается из кеша
+    blob = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.blake2b(blob, digest_size=16).hexdigest()
+
+
+def _sent_cache_get(key):
+    if key is None:
+        return None
+    with _SENT_CACHE_LOCK:
+        entry = _SENT_CACHE.get(key)
+    if entry is None or entry[0] < time.monotonic():
+        return None
+    return entry[1]
+
+
+def _sent_cache_put(key, tg_resp: dict):
+    if key is None:
+        return
+    now = time.monotonic()
+    with _SENT_CACHE_LOCK:
+        _SENT_CACHE.pop(key, None)
+        _SENT_CACHE[key] = (now + SENT_CACHE_TTL, tg_resp)
+        # записи лежат в порядке истечения: старые и лишние снимаются с начала
+        while _SENT_CACHE:
+            oldest_expires_at = next(iter(_SENT_CACHE.values()))[0]
+            if len(_SENT_CACHE) <= SENT_CACHE_SIZE and oldest_expires_at >= now:
+                break
+            _SENT_CACHE.popitem(last=False)
+
+
+def _render_and_send_invoice(task_id: str, payload: dict):
+    try:
+        text = _build_invoice_text(payload) if INVOICE_TEXT_MAX_ITEMS > 0 else None
+        if text is not None:
+            tg_resp = send_message(ADMIN_CHAT_ID, text)
+        else:
+            pdf_bytes, filename, caption, _order_id = _build_invoice_pdf(payload)
+            tg_resp = send_pdf(ADMIN_CHAT_ID, pdf_bytes, filename=filename, caption=caption)
+        _sent_cache_put(_sent_key(payload), tg_resp)
+        return tg_resp
+    except Exception:
+        app.logger.exception("invoice task %s failed", task_id)
+        raise
 
 
 # ----------- OPTIONS (CORS preflight) -----------
 
 @app.route("/admin/invoice/pdf", methods=["OPTIONS"])
 def invoice_pdf_options():
-    return _cors(make_response("", 204))
+    return make_response("", 204)
 
 
 @app.route("/admin/invoice/send", methods=["OPTIONS"])
 def invoice_send_options():
-    return _cors(make_response("", 204))
+    return make_response("", 204)
+
+
+@app.route("/admin/invoice/batch", methods=["OPTIONS"])
+def invoice_batch_options():
+    return make_response("", 204)
+
+
+@app.route("/admin/invoice/status/<task_id>", methods=["OPTIONS"])
+def invoice_status_options(task_id):
+    return make_response("", 204)
 
 
 # ----------- PDF generation (preview) -----------
@@ -551,19 +954,75 @@ def invoice_send_options():
 @app.post("/admin/invoice/pdf")
 @require_internal_token
 def invoice_pdf():
-    payload = request.get_json(silent=True) or {}
+    payload = _get_payload()
 
     try:
         pdf_bytes, filename, _caption, order_id = _build_invoice_pdf(payload)
 
-        resp = make_response(pdf_bytes)
-        resp.headers["Content-Type"] = "application/pdf"
-        resp.headers["Content-Disposition"] = f'inline; filename="{filename}"'
+        # тело отдаётся из BytesIO кусками через wsgi.file_wrapper, без копии в объект ответа
+        resp = send_file(
+            io.BytesIO(pdf_bytes),
+            mimetype="application/pdf",
+            as_attachment=False,
+            download_name=filename,
+            conditional=False,
+            etag=False,
+        )
         resp.headers["Content-Length"] = str(len(pdf_bytes))
         resp.headers["X-Order-Id"] = order_id  # опционально, удобно для логов
-        return _cors(resp)
+        return resp
     except Exception as e:
-        return _cors(jsonify({"ok": False, "error": str(e)})), 500
+        return _json({"ok": False, "error": str(e)}), 500
+
+
+# ----------- Batch: ZIP из нескольких накладных -----------
+
+@app.post("/admin/invoice/batch")
+@require_internal_token
+def invoice_batch():
+    payloads = _get_payload()
+
+    if not isinstance(payloads, list) or not payloads or not all(isinstance(p, dict) for p in payloads):
+        return _json({"ok": False, "error": "payload must be a non-empty JSON array of invoices"}), 400
+
+    if len(payloads) > INVOICE_BATCH_MAX:
+        return _json({"ok": False, "error": f"too many invoices, max {INVOICE_BATCH_MAX}"}), 400
+
+    # накладные собираются параллельно: рендер идёт в процессах пула,
+    # потоки _BATCH_POOL только ждут свои PDF
+    futures = [_BATCH_POOL.submit(_build_invoice_pdf, p) for p in payloads]
+
+    buf = io.BytesIO()
+    try:
+        # PDF уже сжаты, повторное сжатие в ZIP только тратит CPU
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as zf:
+            seen = set()
+            for future in futures:
+                pdf_bytes, filename, _caption, _order_id = future.result(timeout=RENDER_TIMEOUT)
+                # дата в имени файла приходит из payload как есть: "../" в ней дал бы
+                # запись архива вне папки распаковки, поэтому в ZIP идёт только последний компонент
+                filename = os.path.basename(filename.replace("\\", "/"))
+                name, n = filename, 1
+                while name in seen:
+                    n += 1
+                    name = f"{filename[:-4]}_{n}.pdf"
+                seen.add(name)
+                zf.writestr(name, pdf_bytes)
+    except Exception as e:
+        return _json({"ok": False, "error": str(e)}), 500
+
+    size = buf.tell()
+    buf.seek(0)
+    resp = send_file(
+        buf,
+        mimetype="application/zip",
+        as_attachment=True,
+        download_name=f"invoices_{len(payloads)}.zip",
+        conditional=False,
+        etag=False,
+    )
+    resp.headers["Content-Length"] = str(size)
+    return resp
 
 
 # ----------- Send to Telegram -----------
@@ -571,17 +1030,52 @@ def invoice_pdf():
 @app.post("/admin/invoice/send")
 @require_internal_token
 def send_invoice():
-    payload = request.get_json(silent=True) or {}
+    payload = _get_payload()
 
     if not ADMIN_CHAT_ID:
-        return _cors(jsonify({"ok": False, "error": "ADMIN_CHAT_ID is not set"})), 500
+        return _json({"ok": False, "error": "ADMIN_CHAT_ID is not set"}), 500
+
+    if not isinstance(payload, dict):
+        return _json({"ok": False, "error": "payload must be a JSON object"}), 400
+
+    order_id = str(payload.get("order_id") or "UNKNOWN")
+
+    tg_resp = _sent_cache_get(_sent_key(payload))
+    if tg_resp is not None:
+        return _json({"ok": True, "order_id": order_id, "telegram": tg_resp, "cached": True})
+
+    task_id = uuid.uuid4().hex
 
     try:
-        pdf_bytes, filename, caption, order_id = _build_invoice_pdf(payload)
-        tg_resp = send_pdf(ADMIN_CHAT_ID, pdf_bytes, filename=filename, caption=caption)
-        return _cors(jsonify({"ok": True, "order_id": order_id, "telegram": tg_resp}))
+        future = _SEND_POOL.submit(_render_and_send_invoice, task_id, payload)
     except Exception as e:
-        return _cors(jsonify({"ok": False, "error": str(e)})), 500
+        return _json({"ok": False, "error": str(e)}), 500
+
+    with _TASKS_LOCK:
+        _TASKS[task_id] = future
+        while len(_TASKS) > TASKS_SIZE:
+            _TASKS.popitem(last=False)
+
+    return _json({"ok": True, "order_id": order_id, "task_id": task_id}), 202
+
+
+@app.get("/admin/invoice/status/<task_id>")
+@require_internal_token
+def invoice_status(task_id):
+    with _TASKS_LOCK:
+        future = _TASKS.get(task_id)
+
+    if future is None:
+        return _json({"ok": False, "error": "unknown task_id"}), 404
+
+    if not future.done():
+        return _json({"ok": True, "task_id": task_id, "status": "pending"})
+
+    exc = future.exception()
+    if exc is not None:
+        return _json({"ok": False, "task_id": task_id, "status": "failed", "error": str(exc)})
+
+    return _json({"ok": True, "task_id": task_id, "status": "done", "telegram": future.result()})
 
 
 if __name__ == "__main__":
@@ -0,0 +1,23 @@
+# gunicorn подхватывает этот файл из рабочей директории автоматически.
+
+import os
+
+# app.py (Flask, скомпилированный Jinja-шаблон) импортируется один раз в мастере,
+# воркеры наследуют его через copy-on-write; сам WeasyPrint грузится только в процессах пула рендера
+preload_app = True
+
+# ровно один воркер: задачи /admin/invoice/status, кеши PDF и отправленных накладных живут в памяти процесса,
+# со вторым воркером статус отвечал бы 404 на чужие задачи, а повторы не дедуплицировались.
+# WEB_CONCURRENCY сюда не читается; CPU масштабируется через RENDER_PROCESSES, ожидание — через threads
+workers = 1
+
+# потоковые воркеры: пока один поток ждёт Telegram или WeasyPrint, остальные принимают запросы
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+
+def post_worker_init(worker):
+    # keep-alive соединение с Telegram и процессы рендера поднимаются в каждом воркере, а не в мастере до форка
+    from app import _render_pool_prewarm, _tg_prewarm
+    _tg_prewarm()
+    _render_pool_prewarm()